@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def draw_matches(
+    image0: np.ndarray,
+    image1: np.ndarray,
+    pts0: np.ndarray,
+    pts1: np.ndarray,
+    save_path: str | Path = None,
+    pts_col: tuple[int, int, int] = (0, 0, 255),
+    point_size: int = 1,
+    line_col: tuple[int, int, int] = (0, 255, 0),
+    line_thickness: int = 1,
+    margin: int = 10,
+    autoresize: bool = True,
+    max_long_edge: int = 2000,
+    jpg_quality: int = 80,
+    antialias: bool = True,
+) -> np.ndarray:
+    """Plot matching points between two images using OpenCV.
+
+    Arguments compatible with deep_image_matching's `viz_matches_cv2`, but all the
+    lines and all the points are drawn with one `cv2.polylines` call each instead of
+    a Python loop over the tie points. The dots are drawn on top of all lines.
+
+    Args:
+        image0 (np.ndarray): The first image.
+        image1 (np.ndarray): The second image.
+        pts0 (np.ndarray): (N, 2) array of 2D points in the first image.
+        pts1 (np.ndarray): (N, 2) array of 2D points in the second image.
+        save_path (str | Path, optional): Path to save the output image. Defaults to None.
+        pts_col (tuple[int, int, int], optional): BGR color of the points.
+                                                  Defaults to (0, 0, 255).
+        point_size (int, optional): Radius of the points. Defaults to 1.
+        line_col (tuple[int, int, int], optional): BGR color of the matching lines.
+                                                   Defaults to (0, 255, 0).
+        line_thickness (int, optional): Thickness of the matching lines, -1 to draw only
+                                        the points. Defaults to 1.
+        margin (int, optional): Margin between the two images in the output. Defaults to 10.
+        autoresize (bool, optional): Resize the images so that their longest edge is
+                                     `max_long_edge`. Defaults to True.
+        max_long_edge (int, optional): Longest edge of the resized images. Defaults to 2000.
+        jpg_quality (int, optional): Quality of the saved image, if JPEG. Defaults to 80.
+        antialias (bool, optional): Draw anti-aliased lines and points. Rasterizing
+                                    anti-aliased lines is by far the most expensive step
+                                    with many tie points; plain Bresenham lines (False)
+                                    are about 10x faster. Defaults to True.
+
+    Returns:
+        np.ndarray: The output image.
+    """
+    if image0.ndim > 2:
+        image0 = cv2.cvtColor(image0, cv2.COLOR_BGR2GRAY)
+    if image1.ndim > 2:
+        image1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
+
+    if autoresize:
+        H0, W0 = image0.shape
+        H1, W1 = image1.shape
+        scale_factor = max_long_edge / max(H0, W0, H1, W1)
+        image0 = cv2.resize(image0, (int(W0 * scale_factor), int(H0 * scale_factor)))
+        image1 = cv2.resize(image1, (int(W1 * scale_factor), int(H1 * scale_factor)))
+        pts0 = (pts0 * scale_factor).astype(int)
+        pts1 = (pts1 * scale_factor).astype(int)
+
+    H0, W0 = image0.shape
+    H1, W1 = image1.shape
+    out = np.full((max(H0, H1), W0 + margin + W1), 255, np.uint8)
+    out[:H0, :W0] = image0
+    out[:H1, W0 + margin :] = image1
+    out = np.stack([out] * 3, -1)
+
+    # (N, 2, 2) segments from each point in image0 to its match in the right panel
+    mkpts0 = np.round(pts0).astype(np.int32)
+    mkpts1 = np.round(pts1).astype(np.int32) + np.array([W0 + margin, 0], np.int32)
+    segments = np.stack([mkpts0, mkpts1], 1)
+    line_type = cv2.LINE_AA if antialias else cv2.LINE_8
+
+    if line_thickness > -1:
+        cv2.polylines(out, segments, False, line_col, line_thickness, lineType=line_type)
+
+    # A zero-length segment with a round cap of width 2r draws the same disk as cv2.circle(r)
+    dots = np.repeat(segments.reshape(-1, 1, 2), 2, axis=1)
+    cv2.polylines(out, dots, False, pts_col, max(1, 2 * point_size), lineType=line_type)
+
+    if save_path is not None:
+        params = []
+        if Path(save_path).suffix.lower() in (".jpg", ".jpeg"):
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(jpg_quality)]
+        cv2.imwrite(str(save_path), out, params)
+
+    return out
@@ -1,11 +1,18 @@
+import functools
+import hashlib
+import json
 import logging
 import os
-import shlex
+import re
+import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from easydict import EasyDict as edict
 from pyproj import CRS
+from pyproj.exceptions import CRSError
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -16,13 +23,226 @@ MICMAC_PATH = "/opt/micmac/bin/"
 os.environ["PATH"] += f":{MICMAC_PATH}"
 
 # CHECK MICMAC INSTALLATION
-if not Path(MICMAC_PATH).exists():
+# Only look for the executable at import time. Running `mm3d -help` forks the
+# full MICMAC binary, so it is done only when MICMAC_VERIFY=1 is set.
+_MM3D = shutil.which("mm3d") or str(Path(MICMAC_PATH) / "mm3d")
+if not Path(_MM3D).exists():
     logger.error("MICMAC not found in the specified path.")
     raise FileNotFoundError("MICMAC not found in the specified path.")
-try:
-    subprocess.run(["mm3d", "-help"], check=True)
-except subprocess.CalledProcessError:
-    raise RuntimeError("Unable to run MICMAC. Check installation.")
+_MM3D_VERIFIED = False
+
+
+def verify_micmac() -> None:
+    """Checks that MICMAC can be executed by running `mm3d -help` (only once per session)."""
+    global _MM3D_VERIFIED
+    if _MM3D_VERIFIED:
+        return
+    try:
+        subprocess.run(
+            [_MM3D, "-help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except subprocess.CalledProcessError:
+        raise RuntimeError("Unable to run MICMAC. Check installation.")
+    _MM3D_VERIFIED = True
+
+
+if os.environ.get("MICMAC_VERIFY") == "1":
+    verify_micmac()
+
+
+# Subprocess helpers
+def _spawn(cmd: list[str], verbose: bool = True) -> subprocess.Popen:
+    """Starts a MICMAC command with its output piped line by line (or discarded)."""
+    return subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE if verbose else subprocess.DEVNULL,
+        stderr=subprocess.STDOUT,
+        bufsize=1,
+        text=True,
+    )
+
+
+def _log_stream(stream) -> None:
+    """Forwards each line of a subprocess output stream to the logger."""
+    with stream:
+        for line in stream:
+            logger.info("%s", line.rstrip())
+
+
+def _run(cmd: list[str], verbose: bool = True) -> int:
+    """Runs a MICMAC command to completion, streaming its output to the logger.
+
+    Args:
+        cmd (list[str]): The command to execute, as a list of arguments.
+        verbose (bool, optional): If True, log the command output, otherwise discard it.
+                                  Defaults to True.
+
+    Returns:
+        int: The return code of the command.
+    """
+    verbose = verbose and logger.isEnabledFor(logging.INFO)
+    proc = _spawn(cmd, verbose)
+    if verbose:
+        _log_stream(proc.stdout)
+    ret = proc.wait()
+    if ret != 0:
+        logger.error("Command %s exited with code %d", cmd[:2], ret)
+    return ret
+
+
+def _run_async(cmd: list[str], verbose: bool = True) -> subprocess.Popen:
+    """Starts a MICMAC command without waiting for it to complete.
+
+    The output is streamed to the logger from a background thread. Call `wait()` on the
+    returned handle to block until the command finishes.
+
+    Args:
+        cmd (list[str]): The command to execute, as a list of arguments.
+        verbose (bool, optional): If True, log the command output, otherwise discard it.
+                                  Defaults to True.
+
+    Returns:
+        subprocess.Popen: The handle of the running process.
+    """
+    verbose = verbose and logger.isEnabledFor(logging.INFO)
+    proc = _spawn(cmd, verbose)
+    if verbose:
+        threading.Thread(target=_log_stream, args=(proc.stdout,), daemon=True).start()
+    return proc
+
+
+def run_pipeline_parallel(
+    cmds: list[list[str]], max_parallel: int = None, verbose: bool = True
+) -> list[int]:
+    """Runs independent MICMAC commands concurrently.
+
+    Args:
+        cmds (list[list[str]]): The commands to execute. They must not depend on each other.
+        max_parallel (int, optional): Maximum number of commands running at the same time.
+                                      Defaults to None (let ThreadPoolExecutor decide).
+        verbose (bool, optional): If True, log the commands output, otherwise discard it.
+                                  Defaults to True.
+
+    Returns:
+        list[int]: The return codes of the commands, in the same order as `cmds`.
+    """
+    with ThreadPoolExecutor(max_workers=max_parallel) as ex:
+        return list(ex.map(lambda cmd: _run(cmd, verbose), cmds))
+
+
+# Matching strategies accepted by Tapioca
+_TAPIOCA_METHODS = frozenset({"MulScale", "All", "Line", "File", "Graph"})
+
+# Cache of the completed MICMAC steps
+CACHE_DIR = Path(".micmac_cache")
+
+
+def _find_images(pref_im: str, ext_im: str) -> dict[str, str]:
+    """Finds the images in the working directory matching MICMAC's `{pref_im}(.*).{ext_im}` pattern.
+
+    Returns:
+        dict[str, str]: The sorted image names, mapped to the `$1` group of the pattern.
+    """
+    pattern = re.compile(f"{pref_im}(.*).{ext_im}")
+    matches = {}
+    for entry in os.scandir("."):
+        m = pattern.fullmatch(entry.name)
+        if m is not None and entry.is_file():
+            matches[entry.name] = m.group(1)
+    return dict(sorted(matches.items()))
+
+
+def _cache_key(paths: list[str | Path], **params) -> str:
+    """Hashes the stat signature (mtime, size) of the input paths and the step parameters."""
+    h = hashlib.blake2b(digest_size=16)
+    for p in sorted(str(p) for p in paths):
+        try:
+            st = os.stat(p)
+            h.update(f"{p}:{st.st_mtime_ns}:{st.st_size};".encode())
+        except FileNotFoundError:
+            h.update(f"{p}:missing;".encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _cache_manifest(output_dir: str | Path) -> Path:
+    """Returns the manifest of the run that last wrote `output_dir` (one per output directory)."""
+    return CACHE_DIR / f"{Path(output_dir).name}.json"
+
+
+def _cache_read_key(output_dir: str | Path) -> str | None:
+    """Returns the key of the run that last wrote `output_dir`, or None if it is unknown."""
+    manifest = _cache_manifest(output_dir)
+    if not (Path(output_dir).exists() and manifest.exists()):
+        return None
+    try:
+        return json.loads(manifest.read_text()).get("key")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _cache_hit(key: str, output_dir: str | Path) -> bool:
+    """Checks if `output_dir` was last written by a step with the same inputs."""
+    return _cache_read_key(output_dir) == key
+
+
+def _cache_invalidate(output_dir: str | Path) -> None:
+    """Forgets the run that wrote `output_dir`, before a new one starts overwriting it."""
+    _cache_manifest(output_dir).unlink(missing_ok=True)
+
+
+def _cache_store(key: str, output_dir: str | Path, **params) -> None:
+    """Writes the manifest of a successfully completed step."""
+    CACHE_DIR.mkdir(exist_ok=True, parents=True)
+    manifest = {"key": key, "output_dir": str(output_dir), **params}
+    _cache_manifest(output_dir).write_text(json.dumps(manifest, indent=4, default=str))
+
+
+def _tree_signature(path: str | Path) -> str:
+    """Signature of an upstream output directory, used as input of the downstream steps.
+
+    This is the key of the run that last wrote the directory if known. Otherwise it is
+    a hash of the stat of every file in the tree, since the mtime of a directory does not
+    change when the files in its subdirectories are rewritten.
+    """
+    key = _cache_read_key(path)
+    if key is not None:
+        return key
+    h = hashlib.blake2b(digest_size=16)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            h.update(f"{root}/{name}:{st.st_mtime_ns}:{st.st_size};".encode())
+    return h.hexdigest()
+
+
+_SYSPROJ_TEMPLATE = """<?xml version="1.0" ?>
+<SystemeCoord>
+     <BSC>
+          <TypeCoord>eTC_Proj4</TypeCoord>
+          <AuxStr>{proj}</AuxStr>
+     </BSC>
+</SystemeCoord>
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def _crs_to_proj4(epsg: int | str) -> str:
+    """Returns the PROJ.4 string of a projection, caching the (costly) pyproj CRS parsing."""
+    if isinstance(epsg, int):
+        crs = CRS.from_epsg(epsg)
+    elif isinstance(epsg, str):
+        try:
+            crs = CRS.from_string(epsg)
+        except CRSError:
+            crs = CRS.from_user_input(epsg)
+    else:
+        raise ValueError("EPSG must be an integer or string.")
+    return crs.to_proj4()
 
 
 # Workflow steps
@@ -40,30 +260,64 @@ def create_sysproj_xml(epsg: int | str, fname: str = "SysPROJ.xml") -> Path:
 
     fname = Path(fname)
 
-    if fname.exists():
-        fname.unlink()  # Remove if it exists
+    proj = _crs_to_proj4(epsg)
 
-    if isinstance(epsg, int):
-        crs = CRS.from_epsg(epsg)
-    elif isinstance(epsg, str):
-        try:
-            crs = CRS.from_string(epsg)
-        except CRS.CRSException:
-            crs = CRS.from_user_input(epsg)
+    # Write to a temporary file and swap it in, so that MICMAC never reads a partial file
+    tmp = fname.with_suffix(".xml.tmp")
+    tmp.write_text(_SYSPROJ_TEMPLATE.format(proj=proj))
+    os.replace(tmp, fname)
+
+    logger.info("Created SysPROJ.xml file: %s", fname)
+
+    return fname
+
+
+def write_pairs_file(
+    images: list[str | Path],
+    fname: str = "pairs.xml",
+    mode: str = "sequential",
+    overlap: int = 2,
+) -> Path:
+    """Writes the image pairs to be matched by Tapioca in File mode.
+
+    Args:
+        images (list[str | Path]): The images, in acquisition order.
+        fname (str, optional): The filename for the pairs file. Defaults to "pairs.xml".
+        mode (str, optional): How images are paired. "stereo" pairs consecutive images
+                              two by two, "sequential" pairs each image with the next one,
+                              "overlap" pairs each image with the next `overlap` images.
+                              Defaults to "sequential".
+        overlap (int, optional): Number of following images each image is paired with in
+                                 "overlap" mode. Defaults to 2.
+
+    Returns:
+        Path: The Path object representing the created file.
+    """
+
+    names = [Path(im).name for im in images]
+    if mode == "stereo":
+        pairs = zip(names[0::2], names[1::2])
+    elif mode == "sequential":
+        pairs = zip(names[:-1], names[1:])
+    elif mode == "overlap":
+        pairs = (
+            (names[i], names[j])
+            for i in range(len(names))
+            for j in range(i + 1, min(i + 1 + overlap, len(names)))
+        )
     else:
-        raise ValueError("EPSG must be an integer or string.")
-    proj = crs.to_proj4()
+        raise ValueError("Invalid mode. Must be one of: stereo, sequential, overlap")
 
+    # Tapioca File expects the pairs in MICMAC's SauvegardeNamedRel XML format
+    fname = Path(fname)
     with open(fname, "w") as f:
         f.write('<?xml version="1.0" ?>\n')
-        f.write("<SystemeCoord>\n")
-        f.write("     <BSC>\n")
-        f.write("          <TypeCoord>eTC_Proj4</TypeCoord>\n")
-        f.write(f"          <AuxStr>{proj}</AuxStr>\n")
-        f.write("     </BSC>\n")
-        f.write("</SystemeCoord>\n")
+        f.write("<SauvegardeNamedRel>\n")
+        for im0, im1 in pairs:
+            f.write(f"     <Cple>{im0} {im1}</Cple>\n")
+        f.write("</SauvegardeNamedRel>\n")
 
-    logger.info(f"Created SysPROJ.xml file: {fname}")
+    logger.info("Created pairs file: %s", fname)
 
     return fname
 
@@ -76,29 +330,72 @@ def find_tiepoints(
     export_text: bool = False,
     use_schnaps: bool = False,
     verbose: bool = True,
+    pairs_file: Path | None = None,
+    use_cache: bool = True,
 ):
-    """Compute tie points for images."""
+    """Compute tie points for images.
+
+    If `pairs_file` is given (see `write_pairs_file`), only the listed pairs are matched
+    (Tapioca File) and `method` is ignored.
+    If `use_cache` is True, the step is skipped when the Homol directory (and Homol_mini,
+    written by Schnaps if `use_schnaps`) was already computed from the same images and
+    parameters.
+    """
 
     logger.info("Computing tie points...")
 
+    if pairs_file is not None:
+        method = "File"
+
     # Check method
-    if method not in ["MulScale", "All", "Line", "File", "Graph"]:
+    if method not in _TAPIOCA_METHODS:
         raise ValueError(
             "Invalid method. Must be one of: MulScale, All, Line, File, Graph"
         )
+    if method == "File" and pairs_file is None:
+        raise ValueError("A pairs_file must be provided with method File")
     if pref_im is None:
         pref_im = ""
 
-    cmd = f'mm3d Tapioca {method} "{pref_im}(.*).{ext_im}" {resize} ExpTxt={int(export_text)}'
-    if verbose:
-        print(cmd)
-    ret = subprocess.run(shlex.split(cmd), capture_output=True, text=True)
+    inputs = list(_find_images(pref_im, ext_im))
+    if pairs_file is not None:
+        inputs.append(pairs_file)
+    params = dict(
+        step="Tapioca",
+        method=method,
+        resize=resize,
+        export_text=export_text,
+        use_schnaps=use_schnaps,
+    )
+    key = _cache_key(inputs, **params)
+    # Schnaps writes its filtered tie points to a separate Homol_mini directory
+    outputs = ["Homol", "Homol_mini"] if use_schnaps else ["Homol"]
+    if use_cache and all(_cache_hit(key, out) for out in outputs):
+        logger.info("Tie points found in cache, skipping Tapioca.")
+        return
+    for out in outputs:
+        _cache_invalidate(out)
+
+    cmd = [
+        "mm3d",
+        "Tapioca",
+        method,
+        str(pairs_file) if method == "File" else f"{pref_im}(.*).{ext_im}",
+        str(resize),
+        f"ExpTxt={int(export_text)}",
+    ]
     if verbose:
-        print(ret.stdout)
+        logger.info("Running: %s", " ".join(cmd))
+    success = _run(cmd, verbose) == 0
 
     if use_schnaps:
         # Schnaps
-        subprocess.run(["mm3d", "Schnaps", f".*{ext_im}", "MoveBadImgs", 1])
+        cmd = ["mm3d", "Schnaps", f".*{ext_im}", "MoveBadImgs=1"]
+        success = _run(cmd, verbose) == 0 and success
+
+    if success:
+        for out in outputs:
+            _cache_store(key, out, **params)
 
     logger.info("Tie points computed.")
 
@@ -112,23 +409,100 @@ def convert_rpc_info(
     deg: int,
     proj_file: str,
     verbose: bool = True,
+    use_cache: bool = True,
+    n_jobs: int | None = 1,
 ):
-    """Converts RPC information to a general bundle format."""
+    """Converts RPC information to a general bundle format.
 
-    # Convert RPC to general bundle format
-    cmd = f'mm3d Convert2GenBundle "{pref_im}(.*).{ext_im}" "$1.{rpc_ext}" "RPC-d{deg}" Degre={deg} ChSys={proj_file}'
-    # print(cmd)
-    ret = subprocess.run(shlex.split(cmd), capture_output=True, text=True)
-    if verbose:
-        print(ret.stdout)
+    Args:
+        n_jobs (int | None, optional): With 1, a single Convert2GenBundle processes all the
+                                       images. Otherwise one Convert2GenBundle per image is
+                                       run, with up to `n_jobs` of them at the same time
+                                       (None for the number of CPUs). Defaults to 1.
+    """
 
     maltOri_dir = f"RPC-d{deg}"
 
-    logger.info(f"RPC information converted. Output directory: {maltOri_dir}")
+    images = _find_images(pref_im, ext_im)
+    inputs = [*images, *(f"{m}.{rpc_ext}" for m in images.values())]
+    # SysPROJ.xml is rewritten by every create_sysproj_xml call: key on its content, not its mtime
+    proj = Path(proj_file).read_text() if Path(proj_file).exists() else None
+    params = dict(step="Convert2GenBundle", deg=deg, proj=proj)
+    key = _cache_key(inputs, **params)
+    if use_cache and _cache_hit(key, f"Ori-{maltOri_dir}"):
+        logger.info("RPC information found in cache. Output directory: %s", maltOri_dir)
+        return maltOri_dir
+    _cache_invalidate(f"Ori-{maltOri_dir}")
+
+    # Convert RPC to general bundle format
+    if n_jobs == 1:
+        cmd = [
+            "mm3d",
+            "Convert2GenBundle",
+            f"{pref_im}(.*).{ext_im}",
+            f"$1.{rpc_ext}",
+            maltOri_dir,
+            f"Degre={deg}",
+            f"ChSys={proj_file}",
+        ]
+        # logger.info("Running: %s", " ".join(cmd))
+        ret = [_run(cmd, verbose)]
+    else:
+        # The conversions of the images are independent from each other
+        cmds = [
+            [
+                "mm3d",
+                "Convert2GenBundle",
+                im,
+                f"{m}.{rpc_ext}",
+                maltOri_dir,
+                f"Degre={deg}",
+                f"ChSys={proj_file}",
+            ]
+            for im, m in images.items()
+        ]
+        ret = run_pipeline_parallel(
+            cmds, max_parallel=n_jobs or os.cpu_count(), verbose=verbose
+        )
+    if all(r == 0 for r in ret):
+        _cache_store(key, f"Ori-{maltOri_dir}", **params)
+
+    logger.info("RPC information converted. Output directory: %s", maltOri_dir)
 
     return maltOri_dir
 
 
+def convert_rpc_info_parallel(
+    pref_im: str,
+    ext_im: str,
+    rpc_ext: str,
+    deg: int,
+    proj_file: str,
+    n_jobs: int = None,
+    verbose: bool = True,
+    use_cache: bool = True,
+):
+    """Same as `convert_rpc_info`, but runs one Convert2GenBundle per image concurrently.
+
+    With `n_jobs=1` there is nothing to run concurrently: the images are then converted by
+    a single pattern-based Convert2GenBundle, exactly as `convert_rpc_info` does.
+
+    Args:
+        n_jobs (int, optional): Maximum number of conversions running at the same time.
+                                Defaults to None (number of CPUs).
+    """
+    return convert_rpc_info(
+        pref_im,
+        ext_im,
+        rpc_ext,
+        deg,
+        proj_file,
+        verbose=verbose,
+        use_cache=use_cache,
+        n_jobs=n_jobs,
+    )
+
+
 def bundle_adjustment(
     pref_im: str,
     ext_im: str,
@@ -136,20 +510,44 @@ def bundle_adjustment(
     homol_set: str = None,
     export_text: bool = False,
     verbose: bool = True,
+    use_cache: bool = True,
 ):
     """Performs bundle adjustment on the images."""
 
     logger.info("Performing bundle adjustment...")
 
-    # Bundle adjustment
-    cmd = f"mm3d Campari '{pref_im}(.*).{ext_im}') RPC-d{deg} RPC-d{deg}-adj ExpTxt={int(export_text)}"
-    print(cmd)
-    ret = subprocess.run(shlex.split(cmd), capture_output=True, text=True)
-    print(ret.stdout)
-
     maltOri_dir = f"RPC-d{deg}-adj"
 
-    logger.info(f"Bundle adjustment completed. Output directory: {maltOri_dir}")
+    # Campari reads the tie points from Homol, so Homol_mini is not part of the key
+    inputs = list(_find_images(pref_im, ext_im))
+    params = dict(
+        step="Campari",
+        deg=deg,
+        export_text=export_text,
+        homol=_tree_signature("Homol"),
+        ori=_tree_signature(f"Ori-RPC-d{deg}"),
+    )
+    key = _cache_key(inputs, **params)
+    if use_cache and _cache_hit(key, f"Ori-{maltOri_dir}"):
+        logger.info("Bundle adjustment found in cache. Output directory: %s", maltOri_dir)
+        return maltOri_dir
+    _cache_invalidate(f"Ori-{maltOri_dir}")
+
+    # Bundle adjustment
+    cmd = [
+        "mm3d",
+        "Campari",
+        f"{pref_im}(.*).{ext_im}",
+        f"RPC-d{deg}",
+        f"RPC-d{deg}-adj",
+        f"ExpTxt={int(export_text)}",
+    ]
+    if verbose:
+        logger.info("Running: %s", " ".join(cmd))
+    if _run(cmd, verbose) == 0:
+        _cache_store(key, f"Ori-{maltOri_dir}", **params)
+
+    logger.info("Bundle adjustment completed. Output directory: %s", maltOri_dir)
 
     return maltOri_dir
 
@@ -254,4 +652,4 @@ if __name__ == "__main__":
 
     # Correlation into DEM
 
-    print("Done.")
+    logger.info("Done.")
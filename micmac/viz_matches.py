@@ -1,8 +1,123 @@
+import functools
+import logging
+import mmap
+import multiprocessing as mp
+import os
+import threading
 from itertools import combinations
-from multiprocessing import Pool
 from pathlib import Path
 
-from deep_image_matching.io import h5_to_micmac as mm
+import cv2
+import numpy as np
+from _draw_matches import draw_matches
+
+logger = logging.getLogger("micmac")
+
+# Start workers from a lean forkserver (with the drawing modules preloaded)
+# instead of forking the whole parent heap. forkserver is not available on Windows.
+if "forkserver" in mp.get_all_start_methods():
+    _ctx = mp.get_context("forkserver")
+    _ctx.set_forkserver_preload(["cv2", "numpy", "_draw_matches"])
+else:
+    _ctx = mp.get_context()
+
+# Upper bound on the pairs sent to a worker at once, so that the number of
+# queued tasks does not grow with the size of the job
+_MAX_CHUNKSIZE = 8
+
+
+def _load_tiepoints(path: Path) -> np.ndarray:
+    """Reads a MICMAC Homol text file into a (N, 4) float32 array of x0, y0, x1, y1."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.empty((0, 4), dtype=np.float32)
+        # Feed the lines straight from the mapping, without copying the file into a buffer
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm_:
+            return np.loadtxt(
+                iter(mm_.readline, b""),
+                dtype=np.float32,
+                usecols=(0, 1, 2, 3),
+                ndmin=2,
+            )
+
+
+@functools.lru_cache(maxsize=2)
+def _decode_image(path: Path, mtime_ns: int) -> np.ndarray:
+    """Decodes an image in grayscale, cached on its path and mtime."""
+    image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise OSError(f"Unable to read image {path.name}")
+    return image
+
+
+def _read_image(path: Path) -> np.ndarray:
+    """Reads an image in grayscale (as drawn by viz_matches_cv2).
+
+    The last images are kept in memory, as consecutive pairs share their first image.
+    A rewritten image is read again, and the cache is cleared at the end of each
+    `show_micmac_matches` call.
+    """
+    return _decode_image(path, os.stat(path).st_mtime_ns)
+
+
+def _show_pair(
+    matches_path: Path,
+    image_dir: Path,
+    i0_name: str,
+    i1_name: str,
+    out: Path = None,
+    **kwargs,
+) -> np.ndarray:
+    """Same as deep_image_matching's `h5_to_micmac.show_micmac_matches`, but parses the
+    matches file in one pass with numpy and draws the matches in batch (see `draw_matches`).
+    """
+    tiepts = _load_tiepoints(matches_path)
+    image0 = _read_image(image_dir / i0_name)
+    image1 = _read_image(image_dir / i1_name)
+
+    return draw_matches(image0, image1, tiepts[:, :2], tiepts[:, 2:], out, **kwargs)
+
+
+# Context shared by all the tasks of a worker, set once by _init_worker
+_PP: Path = None
+_MD: Path = None
+_KW: dict = {}
+
+
+def _init_worker(pp: Path, md: Path, kw: dict) -> None:
+    """Stores the project path, output directory and plotting kwargs in the worker globals."""
+    global _PP, _MD, _KW
+    _PP, _MD, _KW = pp, md, kw
+    _decode_image.cache_clear()
+
+
+def _task(i0_name: str, i1_name: str) -> None:
+    _show_pair(
+        _PP / "Homol" / f"Pastis{i0_name}" / f"{i1_name}.txt",
+        _PP,
+        i0_name=i0_name,
+        i1_name=i1_name,
+        out=_MD / f"matches_{i0_name}-{i1_name}.png",
+        **_KW,
+    )
+
+
+def _task_star(args: tuple[str, str]) -> None:
+    """Unpacks a task tuple for `Pool.imap_unordered`, which has no starmap variant."""
+    _task(*args)
+
+
+def _bounded(tasks, sem: threading.Semaphore, stop: threading.Event):
+    """Yields the tasks, waiting for a free slot in `sem` before each one.
+
+    The Pool consumes its input eagerly from a background thread, so this is what limits
+    the number of queued tasks. Stops early if `stop` is set.
+    """
+    for task in tasks:
+        while not sem.acquire(timeout=0.1):
+            if stop.is_set():
+                return
+        yield task
 
 
 def show_micmac_matches(
@@ -17,44 +132,101 @@ def show_micmac_matches(
     if not homol_path.exists():
         raise FileNotFoundError(f"Homol path {homol_path} does not exist")
 
-    images = sorted(project_path.glob(img_pattern))
+    # Plain "*<suffix>" patterns are matched in a single scandir pass,
+    # anything else goes through glob
+    suffix = img_pattern[1:]
+    if img_pattern.startswith("*") and not any(c in suffix for c in "*?[]/\\"):
+        images = sorted(
+            (
+                Path(e.path)
+                for e in os.scandir(project_path)
+                if e.name.endswith(suffix) and e.is_file()
+            ),
+            key=lambda p: p.name,
+        )
+    else:
+        images = sorted(project_path.glob(img_pattern))
     matches_dir = project_path / "match_figs"
     matches_dir.mkdir(exist_ok=True, parents=True)
 
+    # A Pool is not worth its startup cost for a single pair or a single CPU
+    n_pairs = len(images) * (len(images) - 1) // 2
+    n_cpus = os.cpu_count() or 1
+    if n_pairs < 2 or n_cpus < 2:
+        parallel = False
+
     if not parallel:
-        for i0, i1 in combinations(images, 2):
-            print(f"Exporting matches between {i0.name} and {i1.name}")
-            matches_path = homol_path / f"Pastis{i0.name}" / f"{i1.name}.txt"
-            if not matches_path.exists():
-                raise FileNotFoundError(f"Matches file {matches_path} does not exist")
-            mm.show_micmac_matches(
-                matches_path,
-                project_path,
-                i0_name=i0.name,
-                i1_name=i1.name,
-                out=matches_dir / f"matches_{i0.name}-{i1.name}.png",
-                **kwargs,
-            )
-            print("Done.")
+        try:
+            # Same order as combinations(images, 2), with the i0 prefixes computed once
+            for idx, i0 in enumerate(images[:-1]):
+                i0_name = i0.name
+                pastis_dir = homol_path / f"Pastis{i0_name}"
+                for i1 in images[idx + 1 :]:
+                    i1_name = i1.name
+                    logger.info("Exporting matches between %s and %s", i0_name, i1_name)
+                    matches_path = pastis_dir / f"{i1_name}.txt"
+                    if not matches_path.exists():
+                        raise FileNotFoundError(
+                            f"Matches file {matches_path} does not exist"
+                        )
+                    _show_pair(
+                        matches_path,
+                        project_path,
+                        i0_name=i0_name,
+                        i1_name=i1_name,
+                        out=matches_dir / f"matches_{i0_name}-{i1_name}.png",
+                        **kwargs,
+                    )
+                    logger.debug("Done.")
+        finally:
+            # Do not keep decoded images (GB-scale for satellite scenes) alive after the call
+            _decode_image.cache_clear()
 
     else:
-        params = [
-            (
-                homol_path / f"Pastis{i0.name}" / f"{i1.name}.txt",
-                project_path,
-                matches_dir / f"matches_{i0.name}-{i1.name}.png",
-            )
-            for i0, i1 in combinations(images, 2)
-        ]
-        with Pool() as p:
-            p.starmap(
-                mm.show_micmac_matches,
-                params,
-            )
+
+        # List the Homol tree once instead of checking each pair,
+        # so that workers never hit a missing file
+        existing = {}
+        with os.scandir(homol_path) as it:
+            for d in it:
+                if d.name.startswith("Pastis") and d.is_dir():
+                    existing[d.name[len("Pastis") :]] = set(os.listdir(d.path))
+
+        # Only the image names travel with each task, the rest is sent once per worker
+        def _gen():
+            for i0, i1 in combinations(images, 2):
+                if f"{i1.name}.txt" in existing.get(i0.name, ()):
+                    yield i0.name, i1.name
+                else:
+                    logger.warning(
+                        "Matches file between %s and %s does not exist, skipping",
+                        i0.name,
+                        i1.name,
+                    )
+
+        processes = min(n_pairs, n_cpus)
+        chunksize = max(1, min(n_pairs // (processes * 4), _MAX_CHUNKSIZE))
+
+        # Keep at most two chunks per worker (2 * _MAX_CHUNKSIZE pairs) in flight,
+        # whatever the number of pairs; slots are released as results come back
+        sem = threading.Semaphore(2 * processes * chunksize)
+        stop = threading.Event()
+        with _ctx.Pool(
+            processes=processes,
+            initializer=_init_worker,
+            initargs=(project_path, matches_dir, kwargs),
+        ) as p:
+            tasks = _bounded(_gen(), sem, stop)
+            try:
+                for _ in p.imap_unordered(_task_star, tasks, chunksize=chunksize):
+                    sem.release()
+            finally:
+                stop.set()
     return None
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     project_path = Path("/home/francesco/phd/stereosat/pleiades_forni/micmac")
     img_pattern = "*.tif"
     show_micmac_matches(project_path, img_pattern, line_thickness=-1)